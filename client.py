@@ -1,34 +1,74 @@
-import copy
+import base64
 import os
 import re
 import requests
-import simplejson
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from lxml import etree
 from urllib3.exceptions import InsecureRequestWarning
 
-from common import error, debug, verbose, getValueByTagReference, listToDict
+from common import NSMAP, error, debug, verbose, getValueByTagReference, listToDict, absPath, hrefPath, loadJSON, dumpJSON
 from generator import GeneratorFactory
 from parser import ParserFactory
-from request import DAVAuthRequest, DAVRequest
+from request import DAVRequest
+
+# scheme prefix of a hostname
+_HOSTNAME = re.compile(r'https?://(.*)')
+
+# parsed API definitions by file path and modification time
+_apicache = {}
+
+# required elements of an operation definition and of the credentials
+_OPERATION_KEYS = frozenset(('method', 'description'))
+_CREDENTIAL_KEYS = frozenset(('hostname', 'endpoint', 'user', 'token'))
+
 
 class ChunkedFile():
-    """ Chunked file upload class to be used with requests package """
+    """ File upload class reading in blocks of at least chunksize bytes, to be used with requests package """
 
-    def __init__(self, filename, chunksize=1024*1024*10):
+    def __init__(self, file, chunksize=1024*1024):
         self.chunksize = chunksize
         try:
-            self.obj = open(filename, 'rb')
+            # accept both a path and an open binary file, unbuffered since reads are large blocks already
+            self.obj = file if hasattr(file, 'read') else open(file, 'rb', buffering=0)
         except Exception as e:
             error(e, 1)
 
-    def __iter__(self):
-        try:
-            data = self.obj.read(self.chunksize)
-        except Exception as e:
-            error(e, 3)
+        # let the kernel read ahead aggressively where supported, only a hint so failures are ignored
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+    def __len__(self):
+        # remaining size, sent as Content-Length instead of using chunked transfer encoding
+        return os.fstat(self.obj.fileno()).st_size - self.obj.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-        yield data
+    def read(self, size=-1):
+        # larger blocks mean fewer read and send calls per upload
+        return self.obj.read(max(size, self.chunksize) if size is not None and size >= 0 else -1)
+
+    def close(self):
+        self.obj.close()
+
+
+class BasicAuth(requests.auth.AuthBase):
+    """ Basic authentication with the header encoded once, an explicit Authorization request header wins """
+
+    def __init__(self, user, token):
+        self.header = "Basic %s" % base64.b64encode(f"{user}:{token}".encode('utf-8')).decode('ascii')
+
+    def __call__(self, r):
+        r.headers.setdefault('Authorization', self.header)
+        return r
 
 
 class WebDAVClient():
@@ -36,70 +76,100 @@ class WebDAVClient():
 
     def __init__(self, options):
         self.args = {}
+        self.argsdict = {}
         self.results = None
         self.options = options
         self.headers = {}
+        self.data = ""
         self.operation = None
 
+        # shared session to keep connections alive across requests, with a
+        # connection per concurrent request so none of them are discarded
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=max(32, self.options['concurrency']))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         self._loadapi()
 
     def _loadapi(self):
-        # load API definition
+        # load API definition, post-processed once per version of the file
         try:
-            with open(self.options['api'], "r") as f:
-                text = f.read()
-            self.api = simplejson.loads(text)
-
-            # post-process API definition
-            for o, ov in self.api.items():
-                # operation definition completeness test
-                missing = ['method', 'description'] - ov.keys()
-                if len(missing) > 0:
-                    error("missing definition elements for operation '{o}': '%s'" % "\', \'".join(missing), 1)
-
-                # parsing
-                if "parsing" in ov and "variables" in ov["parsing"]:
-                    for k, v in ov["parsing"]["variables"].items():
-                        if not isinstance(v, dict):
-                            ov["parsing"]["variables"][k] = {"xpath": v}
-
-                # ensure options and arguments
-                if "options" not in ov:
-                    ov["options"] = {}
-                if "arguments" not in ov:
-                    ov["arguments"] = {"min": 1, "max": 1}
-
-                # set operation-specific option values if operation set
-                if o == self.operation:
-                    for (option, value) in ov["options"].items():
-                        if option not in self.options:
-                            raise Exception(f"invalid option {option}")
-                        # alter only if set application option does not differs from default
-                        if self.options[option] == self.options["defaults"][option]:
-                            self.options[option] = value
+            filename = os.path.abspath(self.options['api'])
+            key = (filename, os.path.getmtime(filename))
+            if key not in _apicache:
+                with open(filename, "rb") as f:
+                    _apicache[key] = self._processapi(loadJSON(f.read()))
+            self.api = _apicache[key]
+
+            # set operation-specific option values if operation set
+            if self.operation in self.api:
+                for (option, value) in self.api[self.operation]["options"].items():
+                    if option not in self.options:
+                        raise Exception(f"invalid option {option}")
+                    # alter only if set application option does not differs from default
+                    if self.options[option] == self.options["defaults"][option]:
+                        self.options[option] = value
         except Exception as e:
             error(f"api load failed: {e}", 1)
 
+    def _processapi(self, api):
+        # post-process API definition
+        for o, ov in api.items():
+            # operation definition completeness test
+            missing = _OPERATION_KEYS - ov.keys()
+            if len(missing) > 0:
+                error("missing definition elements for operation '{o}': '%s'" % "\', \'".join(missing), 1)
+
+            # ensure options and arguments
+            if "options" not in ov:
+                ov["options"] = {}
+            if "arguments" not in ov:
+                ov["arguments"] = {"min": 1, "max": 1}
+
+        return api
+
+    def _processoperation(self, ov):
+        # post-process the parsing definitions of the invoked operation only, once
+        if ov.get("_processed"):
+            return
+
+        # parsing, compile the alternative paths of each variable once, relative to the item element
+        for p in ov.get("parsing", []):
+            # item element in Clark notation, matched directly while parsing
+            prefix, _, name = p.get("items", "response").rpartition(':')
+            p["_tag"] = "{%s}%s" % (NSMAP[prefix or "d"], name)
+
+            for k, v in p.get("variables", {}).items():
+                if not isinstance(v, dict):
+                    v = p["variables"][k] = {"xpath": v}
+                v["_compiled"] = [etree.XPath("/".join(s if ':' in s else f"d:{s}" for s in paths.split('/')),
+                                              namespaces=NSMAP, smart_strings=False)
+                                  for paths in v["xpath"].split('|')]
+
+        ov["_processed"] = True
+
     def credentials(self, filename):
         try:
-            with open(os.path.abspath(filename), "r") as f:
-                text = f.read()
-            self.options["credentials"] = simplejson.loads(text)
+            with open(os.path.abspath(filename), "rb") as f:
+                self.options["credentials"] = loadJSON(f.read())
         except Exception as e:
             error(f"credentials loading failed: {e}", 1)
 
-        debug(f"credentials file '{filename}'")
+        debug("credentials file '%s'", filename)
 
         # credentials completeness test
-        required = ['hostname', 'endpoint', 'user', 'token']
-        missing = required - self.options["credentials"].keys()
+        missing = _CREDENTIAL_KEYS - self.options["credentials"].keys()
         if len(missing) > 0:
             error('missing credential elements: %s' % ", ".join(missing), 1)
 
-        self.options["credentials"]["domain"] = re.sub(r'https?://(.*)', '\\1', self.options["credentials"]["hostname"])
+        self.options["credentials"]["domain"] = _HOSTNAME.sub('\\1', self.options["credentials"]["hostname"])
+
+        # authenticate all requests of the session, as session auth so no netrc entry replaces the credentials
+        self.session.auth = BasicAuth(self.options["credentials"]["user"], self.options["credentials"]["token"])
 
         # apply any other settings
-        self.options.update({x: self.options["credentials"][x] for x in self.options["credentials"].keys() - required})
+        self.options.update({x: self.options["credentials"][x] for x in self.options["credentials"].keys() - _CREDENTIAL_KEYS})
 
         verbose(self.options["credentials"])
 
@@ -112,10 +182,13 @@ class WebDAVClient():
 
         # copy arguments
         self.options["operation"] = operation
-        self.args = copy.deepcopy(args)
+        self.args = list(args)
+
+        self._processoperation(self.api[operation])
 
         # set arguments
-        self.defs = self.api[operation]
+        # copy the arguments, which are resolved below, to keep the shared definition intact
+        self.defs = dict(self.api[operation], arguments=dict(self.api[operation]["arguments"]))
         if "min" in self.defs["arguments"] and "max" in self.defs["arguments"]:
             if len(self.args) < self.defs["arguments"]["min"] or len(self.args) > self.defs["arguments"]["max"]:
                 error("incorrect number of arguments", 1)
@@ -127,14 +200,17 @@ class WebDAVClient():
                 else:
                     self.args.append("")
 
+        # arguments by index for value tag references
+        self.argsdict = listToDict(self.args)
+
         # process arguments other than min, max
         for k, v in filter(lambda x: not x[0] in ["min", "max"], self.defs["arguments"].items()):
             # replace reference in argument value
-            self.defs["arguments"][k] = getValueByTagReference(v, listToDict(self.args))
+            self.defs["arguments"][k] = getValueByTagReference(v, self.argsdict)
 
         # make sure a forward slash precedes the path
-        self.options["root"] = (f"/{self.args[0]}").replace('//', '/')
-        self.options["target"] = ("/%s" % (self.args[1] if len(self.args) > 1 else "")).replace('//', '/')
+        self.options["root"] = absPath(self.args[0])
+        self.options["target"] = absPath(self.args[1] if len(self.args) > 1 else "")
 
         return True
 
@@ -154,6 +230,9 @@ class WebDAVClient():
         if not self.exists() or not self.confirm():
             return False
 
+        # set headers and data once, shared by all recursive requests
+        self.prepare()
+
         # do request
         self.results = self.doRequest(self.options)
 
@@ -166,8 +245,10 @@ class WebDAVClient():
             try:
                 if os.path.exists(self.defs["arguments"]["target"]) and not self.options["overwrite"]:
                     error(f"target file {self.defs['arguments']['target']} already exists", 1)
+                # write the streamed response body in blocks
                 with open(self.defs["arguments"]["target"], "wb") as f:
-                    f.write(self.results.encode('utf-8'))
+                    for chunk in self.results.iter_content(1024*1024):
+                        f.write(chunk)
             except Exception as e:
                 error(e, 1)
             self.results = True
@@ -199,14 +280,10 @@ class WebDAVClient():
             # conditional headers to be implemented
             pass
         else:
-            self.headers[tag] = getValueByTagReference(value, listToDict(self.args), self.options)
-
-    def doRequest(self, options={}):
-        # replace client options by local options
-        opts = copy.deepcopy(self.options)
-        opts.update(options)
+            self.headers[tag] = getValueByTagReference(value, self.argsdict, self.options)
 
-        self.request = DAVAuthRequest(options)
+    def prepare(self):
+        """ Set the request headers and data, which do not depend on the request path """
 
         # set request headers if required
         if "headers" in self.defs:
@@ -214,21 +291,40 @@ class WebDAVClient():
                 self.setHeader(h, v)
 
         # add data to request if required
-        data = ""
+        self.data = ""
         if "file" in self.defs["arguments"]:
-            # create file upload object and set content type
-            data = ChunkedFile(self.defs["arguments"]["file"])
+            # create file upload object, streamed by requests, and set content type
+            self.data = ChunkedFile(self.defs["arguments"]["file"], self.options['upload-chunk-size'])
             self.headers['Content-Type'] = 'application/octet-stream'
         elif "data" in self.defs:
             gen = GeneratorFactory.getGenerator(self.defs["data"], self.options)
-            data = gen.generate(self.defs["data"])
+            self.data = gen.generate(self.defs["data"])
             self.headers['Content-Type'] = gen.getContentType()
 
-        # run request, exits early if dry-run
-        response = self.request.run(self.defs["method"], opts["source"], headers=self.headers, data=data)
+    def doRequest(self, options={}):
+        # replace client options by local options
+        opts = {**self.options, **options}
 
-        # return if failed
+        self.request = DAVRequest(opts, self.session)
+        data = self.data
+
+        # stream the response if it is to be stored in a target file
+        stream = self.defs["arguments"].get("target", "") > ""
+
+        # run request, exits early if dry-run, XML data is only passed on undecoded if it is parsed
+        try:
+            response = self.request.run(self.defs["method"], opts["source"], headers=self.headers, data=data, stream=stream,
+                                        raw="parsing" in self.defs)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+        # return if failed, reporting failed existence requirements
         if not self.request.hassuccess() or response is None:
+            if self.defs["options"].get("exists") and self.request.response.status_code == 404:
+                return error(f"cannot {self.defs['method']}: source path {opts['source']} does not exist")
+            elif self.defs["options"].get("exists") and self.request.response.status_code == 412:
+                return error(f"cannot {self.defs['method']}: target path {opts['target']} already exists")
             return error(f"{self.request.response.status_code} {self.request.response.reason}")
 
         # exit if dry-run
@@ -236,10 +332,10 @@ class WebDAVClient():
             return False
 
         # return immediately without response if no parsing defined
-        if "parsing" not in self.defs and "filename" not in self.request.download:
+        if "parsing" not in self.defs and "filename" not in self.request.download and not stream:
             return True
-        # return immediately if no parsing requested
-        if opts['no-parse'] or "filename" in self.request.download:
+        # return immediately if no parsing requested or streaming
+        if opts['no-parse'] or "filename" in self.request.download or stream:
             return response
 
         # parse request response
@@ -247,37 +343,85 @@ class WebDAVClient():
 
         # recursive processing
         if self.options['recursive']:
-            recursiveresults = []
-            for res in [r for r in results if r['scope'] == 'response']:
-                if res['type'] == 'd':
-                    recursiveresults += self.doRequest({"source": "%s%s" % (self.options["source"], self.getRelativePath(res, "path"))})
-            results += recursiveresults
+            self.doRecursive(results, opts)
 
         return results
 
-    def exists(self):
-        if "exists" not in self.defs["options"] or not self.defs["options"]["exists"]:
-            return True
-
-        req = DAVAuthRequest(self.options)
+    def doRecursive(self, results, options):
+        """ Request all subdirectories concurrently and add their results to the parent results """
+
+        found = {}
+        children = {}
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            # submit each directory as soon as its parent has been listed
+            pending = set()
+            top = []
+            for href, path in self.getDirectories(results, options["source"]):
+                top.append(href)
+                pending.add(executor.submit(self.doSubRequest, href, path, options))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    href, path, subresults = future.result()
+                    found[href] = subresults
+                    # subdirectories per parent in listing order
+                    children[href] = []
+                    for subhref, subpath in self.getDirectories(subresults, path):
+                        children[href].append(subhref)
+                        pending.add(executor.submit(self.doSubRequest, subhref, subpath, options))
+
+        # merge depth-first in listing order, independent of the order in which the responses arrived
+        stack = top[::-1]
+        while stack:
+            href = stack.pop()
+            for r, sr in zip(results, found[href]):
+                if type(r.result) is list and type(sr.result) is list:
+                    r.result += sr.result
+            stack.extend(reversed(children[href]))
+
+    def doSubRequest(self, href, path, options):
+        """ Request and parse a single subdirectory, can run in parallel """
+
+        # the prepared headers and data are shared, only the path differs
+        opts = {**options, "source": path}
+        request = DAVRequest(opts, self.session)
+        # request the path as quoted by the server, the unquoted path is for comparison and display only
+        response = request.run(self.defs["method"], href, headers=self.headers, data=self.data, raw=True)
+
+        if not request.hassuccess() or response is None:
+            error(f"{path}: {request.response.status_code} {request.response.reason}")
+            return href, path, []
+
+        return href, path, self.parse(response, opts)
+
+    def getDirectories(self, results, source):
+        """ Get the raw and unquoted paths of all listed directories, except for source itself """
+
+        endpoint = self.options["credentials"]["endpoint"]
+        paths = []
+        for r in results:
+            if not r['scope'] == 'response' or type(r.result) is not list:
+                continue
+            for item in r.result:
+                if item.get('type') != 'd' or 'path' not in item:
+                    continue
+                path = hrefPath(item['path'], endpoint)
+                if path != source.rstrip('/'):
+                    paths.append((hrefPath(item['path'], endpoint, False), path))
 
-        # check if the source path exists
-        req.run("propfind", self.options["source"], quiet=True)
+        return paths
 
-        if req.response.status_code not in DAVRequest.SUCCESS:
-            return error(f"cannot {self.defs['method']}: source path {self.options['source']} does not exist")
+    def exists(self):
+        """ Set existence headers, the request itself fails on a missing source or existing target """
 
-        if self.args[1] == "":
+        if "exists" not in self.defs["options"] or not self.defs["options"]["exists"]:
             return True
 
-        # check if the target path does not exists
-        req.run("propfind", self.options["target"], quiet=True)
-
-        if req.response.status_code in DAVRequest.SUCCESS:
-            if not self.options['overwrite']:
-                return error(f"cannot {self.defs['method']}: target path {self.options['target']} already exists")
-            else:
-                self.headers['Overwrite'] = 'T'
+        # only overwrite an existing target if requested, the server answers 412 otherwise
+        if self.args[1] > "":
+            self.headers['Overwrite'] = 'T' if self.options['overwrite'] else 'F'
 
         return True
 
@@ -303,7 +447,13 @@ class WebDAVClient():
         return True
 
     def parse(self, data, options):
-        return list(map(lambda p: ParserFactory.getParser(p, data, options), self.defs.get('parsing', [])))
+        parsing = self.defs.get('parsing', [])
+
+        # a streamed response body can only be read once
+        if hasattr(data, 'read') and len(parsing) > 1:
+            data = data.read()
+
+        return list(map(lambda p: ParserFactory.getParser(p, data, options), parsing))
 
     def format(self):
         """ Format the result of the request """
@@ -312,6 +462,6 @@ class WebDAVClient():
             if type(self.results) is etree._Element:
                 return etree.tostring(self.results).decode('utf-8')
             elif type(self.results) is dict:
-                return simplejson.dumps(self.results)
+                return dumpJSON(self.results)
 
         return self.results if self.results is str else f"{self.results}"
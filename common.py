@@ -1,13 +1,45 @@
-import sys, inspect, re, urllib, functools
+import sys, re, urllib.parse
+
+# use orjson for JSON data if available
+try:
+    import orjson
+
+    def loadJSON(data):
+        return orjson.loads(data)
+
+    def dumpJSON(data):
+        return orjson.dumps(data).decode('utf-8')
+except ImportError:
+    import json
+
+    def loadJSON(data):
+        return json.loads(data)
+
+    def dumpJSON(data):
+        return json.dumps(data)
 
 
 # current options global
 options = {}
 
+# XML namespaces by prefix
+NSMAP = {"d": "DAV:", "oc": "http://owncloud.org/ns", "nc": "http://nextcloud.org/ns"}
+
+# size units per base
+_UNITS = {
+    1000: ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"),
+    1024: ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
+}
+
+# value tag references: @<index> or @{<name>}
+_TAG_REFERENCE = re.compile(r'@([0-9]+)|@{([\w\.\-]+)}')
+
 
 def getFromDict(dataDict, mapList, valueOnError=None):
     try:
-        return functools.reduce(lambda d, k: d[k], mapList, dataDict)
+        for k in mapList:
+            dataDict = dataDict[k]
+        return dataDict
     except Exception:
         return valueOnError
 
@@ -16,24 +48,42 @@ def makeHuman(value, addBytes=False, base=1000, decimals=1):
     if not options['human']:
         return "%d%s" % (value, " bytes" if addBytes else "")
 
-    units = {
-        1000: ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"),
-        1024: ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
-    }
+    base = base if base in _UNITS.keys() else 1000
+    units = _UNITS[base]
+
+    # find the largest unit not exceeding the value
+    i = 0
+    threshold = base
+    while i < len(units) - 1 and value > threshold:
+        i += 1
+        threshold *= base
+
+    if i == 0:
+        return f"{value} {units[0]}"
 
-    base = base if base in units.keys() else 1000
-    i = 1
-    while i < len(units[base]) and value > (base ** i):
+    # move up a unit if rounding reaches the base, e.g. 999999 is 1.0 MB and not 1000.0 KB
+    scaled = value / (threshold // base)
+    if round(scaled, decimals) >= base and i < len(units) - 1:
         i += 1
+        scaled /= base
 
-    return "%.03s %s" % (((value*(10**decimals)) / (base ** (i-1))) / (10**decimals) if i > 1 else value, units[base][i-1])
+    return f"{scaled:.{decimals}f} {units[i]}"
 
 
 def relativePath(r, var, root, endpoint):
-    # remove endpoint, root folder and unquote
-    val = r[var].replace(endpoint, "")
-    val = val.replace(root, "", 1)
-    val = urllib.parse.unquote(val)
+    # remove endpoint and root folder, by slicing if the path starts with both, keeping
+    # the slash after the root so a root of / or with a trailing slash is handled alike
+    val = r[var]
+    root = root.rstrip('/')
+    prefix = endpoint + root
+    if val.startswith(prefix):
+        val = val[len(prefix):]
+    else:
+        val = val.replace(endpoint, "").replace(root, "", 1)
+
+    # unquote only if required
+    if '%' in val:
+        val = urllib.parse.unquote(val)
 
     # add leading slash
     sp = val.split('/')
@@ -45,39 +95,64 @@ def relativePath(r, var, root, endpoint):
     return val
 
 
+def absPath(path):
+    # make sure a single forward slash precedes the path
+    return path if path.startswith('/') and not path.startswith('//') else '/' + path.lstrip('/')
+
+
+def hrefPath(href, endpoint, unquote=True):
+    # unquote unless the raw path is required, remove endpoint and trailing slash
+    if unquote:
+        path = urllib.parse.unquote(href) if '%' in href else href
+        endpoints = (endpoint,)
+    else:
+        # the endpoint may be quoted in a raw href
+        path = href
+        endpoints = (urllib.parse.quote(urllib.parse.unquote(endpoint)), endpoint)
+
+    for e in endpoints:
+        if e in path:
+            path = path[path.find(e) + len(e):]
+            break
+
+    return path.rstrip('/')
+
+
 def listToDict(*args):
     return dict(zip(map(str, range(len(*args))), *args))
 
 
 def getValueByTagReference(v, *args):
-    for m in re.findall(r'@([0-9]+)|@{([\w\.\-]+)}', v):
-        rv = m[1] if m[1] > '' else m[0]
-        rs = "@%s" % (("{%s}" % m[1]) if m[1] > '' else m[0])
+    # most values contain no references at all
+    if '@' not in v:
+        return v
+
+    def replace(m):
+        rv = m.group(2) if m.group(2) else m.group(1)
+        ov = None
         for d in args:
             ov = getFromDict(d, rv.split('.'))
             if ov:
                 break
         if ov is None:
-            warning("value reference: tag %s does not exist in provided data" % rs)
-        v = v.replace(rs, str(ov)) if ov else v
-    return v.replace('@@', '@')
+            warning("value reference: tag %s does not exist in provided data", m.group(0))
+        return str(ov) if ov else m.group(0)
+
+    # replace all references in a single pass
+    return _TAG_REFERENCE.sub(replace, v).replace('@@', '@')
 
 
 def message(target, msg, msgtype="", color='\x1b[0m', ret=True):
     target.flush()
 
-    frames = inspect.stack()
-
-    try:
-        if not options['no-colors']:
-            target.write(color)
+    if not options['no-colors']:
+        target.write(color)
 
-        target.write('%s:\x1b[0m %s\n' % ("%% %s()" % frames[2][3] if msgtype in ["debug", "verbose"] else msgtype, msg))
+    # name of the function calling the message function
+    target.write('%s:\x1b[0m %s\n' % ("%% %s()" % sys._getframe(2).f_code.co_name if msgtype in ["debug", "verbose"] else msgtype, msg))
 
-        if not options['no-colors']:
-            target.write('\x1b[0m')
-    finally:
-        del frames
+    if not options['no-colors']:
+        target.write('\x1b[0m')
 
     target.flush()
 
@@ -101,31 +176,31 @@ def error(msg, code=None, ret=False):
     return ret
 
 
-def warning(msg, ret=False):
-    ''' Print warning message'''
+def warning(msg, *args, ret=False):
+    ''' Print warning message, formatted with args only if printed '''
 
     if options['quiet']:
         return ret
 
-    return message(sys.stdout, msg, "warning", color="\x1b[96m", ret=ret)
+    return message(sys.stdout, msg % args if args else msg, "warning", color="\x1b[96m", ret=ret)
 
 
-def verbose(msg, ret=True):
-    ''' Print verbose text '''
+def verbose(msg, *args, ret=True):
+    ''' Print verbose text, formatted with args only if printed '''
 
     if not options['verbose']:
         return ret
 
-    return message(sys.stdout, msg, "verbose", '\x1b[33m', ret=ret)
+    return message(sys.stdout, msg % args if args else msg, "verbose", '\x1b[33m', ret=ret)
 
 
-def debug(msg, force=False, ret=True):
-    ''' Print debug message'''
+def debug(msg, *args, force=False, ret=True):
+    ''' Print debug message, formatted with args only if printed '''
 
     if not options['debug'] and not force:
         return ret
 
-    return message(sys.stdout, msg, "debug", '\x1b[32m', ret=ret)
+    return message(sys.stdout, msg % args if args else msg, "debug", '\x1b[32m', ret=ret)
 
 
 def note(msg, ret=True):
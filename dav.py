@@ -7,7 +7,7 @@
     Packages: see requirements.txt
 """
 
-import sys, getopt, copy
+import sys, getopt
 
 from client import WebDAVClient
 import common
@@ -17,6 +17,24 @@ from common import error, note
 TITLE = "CompactDAV"
 VERSION = "1.1"
 
+# define quick options, long: short
+QUICKOPTS = {"overwrite": "o", "headers": "", "head": "", "no-parse": "", "recursive": "R", "sort": "", "reverse": "r",
+             "dirs-first": "t", "files-only": "f", "dirs-only": "d", "summary": "u", "list-empty": "e", "checksum": "",
+             "human": "h", "confirm": "y", "exists": "", "no-path": "", "verbose": "v", "no-verify": "k", "hide-root": "",
+             "debug": "", "dry-run": "n", "quiet": "q", "no-colors": "", "api=": "", "credentials-file=": "c:", "printf=": "p:",
+             "upload-chunk-size=": "", "concurrency=": "", "help": "", "version": ""}
+
+# getopt arguments, built once
+SHORTOPTS = "".join(v for v in QUICKOPTS.values() if v)
+LONGOPTS = list(QUICKOPTS.keys())
+
+# remove = and : in options, map short options to long ones
+QUICKOPTS_PLAIN = dict((k.replace('=', ''), v.replace(':', '')) for k, v in QUICKOPTS.items())
+SHORT2LONG = {v: k for k, v in QUICKOPTS_PLAIN.items() if v}
+
+# options taking a positive integer
+INTOPTS = ("upload-chunk-size", "concurrency")
+
 
 class ClientOptions(dict):
     def __init__(self, options, defaults):
@@ -33,27 +51,30 @@ def usage():
     print("usage: dav.py <operation> <options> <args..>")
 
 
-def help(wd, operation, quickopts):
+def help(wd, operation):
     if operation == "" or operation not in wd.api.keys():
         version()
         usage()
 
-        # get maximum length of name of operation
-        maxop = str(max(map(lambda x: len(x[0]), wd.api.items())) + 2)
+        # get maximum length of name of operation, build line format once
+        fmtop = "%-" + str(max(map(len, wd.api.keys())) + 2) + "s %s"
         # print operations
         print("\nOperations:")
         for o, ov in wd.api.items():
-            print(("%-" + maxop + "s %s") % (o, ov["description"]))
+            print(fmtop % (o, ov["description"]))
 
-        # get maximum length of name of options, and value
-        maxopk = str(max(map(lambda x: len(x), wd.options.keys())))
+        # get maximum length of name of options, and value, build line formats once
+        maxopk = max(map(len, wd.options.keys()))
+        fmtopt = "%s --%-" + str(maxopk) + "s  %s %s"
+        fmtset = "%s %-" + str(maxopk) + "s"
+        blank = " " * (maxopk + 7)
         # print options
         print("\nOptions:")
-        for k, v in quickopts.items():
+        for k, v in QUICKOPTS.items():
             kr = k.replace('=', '')
-            print(("%s --%-" + maxopk + "s  %s %s") % ("-%s " % v[0] if v else "   ",
+            print(fmtopt % ("-%s " % v[0] if v else "   ",
                   kr,
-                  ("%s %-" + maxopk + "s") % ("Enable" if kr == k else "Set", kr if kr in wd.options["defaults"].keys() else " " * (int(maxopk) + 7)),
+                  fmtset % ("Enable" if kr == k else "Set", kr if kr in wd.options["defaults"].keys() else blank),
                   "%s(default: '%s')" % ("" if kr == k else " " * 3, wd.options["defaults"][kr] if kr in wd.options["defaults"].keys() else "")))
     else:
         # determine required and optional arguments for operation
@@ -86,27 +107,19 @@ def main(argv):
         "api": "webdav.json",
         "credentials-file": "credentials.json",
         "printf": "{date} {size:r} {path}",
-        "timeout": 86400
+        "timeout": 86400,
+        "upload-chunk-size": 1048576,
+        "concurrency": 8
     }
 
-    # define quick options, long: short
-    quickopts = {"overwrite": "o", "headers": "", "head": "", "no-parse": "", "recursive": "R", "sort": "", "reverse": "r",
-                 "dirs-first": "t", "files-only": "f", "dirs-only": "d", "summary": "u", "list-empty": "e", "checksum": "",
-                 "human": "h", "confirm": "y", "exists": "", "no-path": "", "verbose": "v", "no-verify": "k", "hide-root": "",
-                 "debug": "", "dry-run": "n", "quiet": "q", "no-colors": "", "api=": "", "credentials-file=": "c:", "printf=": "p:", "help": "", "version": ""}
-
-    # remove = and : in options
-    quickoptsm = dict((k.replace('=', ''), v.replace(':', '')) for k, v in quickopts.items())
-
     # assign values to quick options
-    defaults = dict(defaults, **{k: False for k in quickoptsm.keys() if k not in defaults})
-    common.options = ClientOptions(copy.deepcopy(defaults), copy.deepcopy(defaults))
+    for k in QUICKOPTS_PLAIN:
+        defaults.setdefault(k, False)
+    common.options = ClientOptions(dict(defaults), dict(defaults))
 
     # handle arguments
     try:
-        opts, args = getopt.gnu_getopt(argv,
-                                       "".join(list(filter(lambda x: x > "", quickopts.values()))),
-                                       list(quickopts.keys()))
+        opts, args = getopt.gnu_getopt(argv, SHORTOPTS, LONGOPTS)
     except getopt.GetoptError as e:
         error(e, 1)
 
@@ -115,17 +128,26 @@ def main(argv):
 
     # parse options and arguments
     for opt, arg in opts:
-        if opt[2:] in quickoptsm.keys():
+        if opt[2:] in QUICKOPTS_PLAIN:
             common.options[opt[2:]] = arg if arg > "" else True
-        elif opt[1:] in quickoptsm.values():
-            index = [k for k, v in quickoptsm.items() if v == opt[1:]][0]
-            common.options[index] = arg if arg > "" else True
+        elif opt[1:] in SHORT2LONG:
+            common.options[SHORT2LONG[opt[1:]]] = arg if arg > "" else True
+
+    # convert and check numeric options once
+    for k in INTOPTS:
+        try:
+            value = int(common.options[k])
+        except ValueError:
+            value = 0
+        if value < 1:
+            error(f"invalid {k} value: {common.options[k]}", 1)
+        common.options[k] = value
 
     # create object and read credentials
     wd = WebDAVClient(common.options)
 
     if common.options['help']:
-        help(wd, operation, quickopts)
+        help(wd, operation)
         sys.exit(0)
     elif common.options['version']:
         version()
@@ -2,8 +2,19 @@
     Author: hevp
 """
 
+from functools import lru_cache
 from lxml import etree
-from common import error, getValueByTagReference
+from common import NSMAP, error, getValueByTagReference
+
+
+@lru_cache(maxsize=None)
+def _getXMLTag(tag):
+    """ Get a prefixed tag in Clark notation, tag names recur in each generated body """
+
+    if ':' in tag:
+        prefix, name = tag.split(':', 1)
+        tag = "{%s}%s" % (NSMAP[prefix], name)
+    return tag
 
 
 class GeneratorFactory():
@@ -24,32 +35,29 @@ class XMLGenerator(Generator):
     def getContentType(self):
         return 'application/xml'
 
-    def _getXMLTag(self, tag, nsmap):
-        if ':' in tag:
-            tags = tag.split(':')
-            tag = "{%s}%s" % (nsmap[tags[0]], tags[1])
-        return tag
-
-    def generate(self, data, element=None):
-        NSMAP = {"d": "DAV:", "oc": "http://owncloud.org/ns", "nc": "http://nextcloud.org/ns"}
-
+    def generate(self, data):
         try:
-            # create the element itself
-            xml = etree.Element(self._getXMLTag(data["root"], NSMAP), nsmap=NSMAP) if element is None else element
-
-            # create any children recursively
-            for k, v in (data["elements"].items() if element is None else data.items()):
-                sub = etree.SubElement(xml, self._getXMLTag(k, NSMAP), nsmap=NSMAP)
-                if type(v) is dict:
-                    self.generate(v, sub)
-                elif type(v) is list:
-                    for value in v:
-                        lk = getValueByTagReference(value.keys()[0], self.data)
-                        lv = getValueByTagReference(value.values()[0], self.data)
-                        prop = etree.SubElement(sub, self._getXMLTag(lk, NSMAP), nsmap=NSMAP)
-                        prop.text = getValueByTagReference(lv, self.data)
-                else:
-                    sub.text = getValueByTagReference(v, self.data)
+            # create the root element itself
+            xml = etree.Element(_getXMLTag(data["root"]), nsmap=NSMAP)
+
+            # create all children, using a worklist of elements and their definitions instead of recursion
+            work = [(xml, data["elements"])]
+            while work:
+                element, elements = work.pop()
+                for k, v in elements.items():
+                    sub = etree.SubElement(element, _getXMLTag(k), nsmap=NSMAP)
+                    if type(v) is dict:
+                        work.append((sub, v))
+                    elif type(v) is list:
+                        for value in v:
+                            # single key-value pair per value
+                            lk, lv = next(iter(value.items()))
+                            lk = getValueByTagReference(lk, self.data)
+                            lv = getValueByTagReference(lv, self.data)
+                            prop = etree.SubElement(sub, _getXMLTag(lk), nsmap=NSMAP)
+                            prop.text = getValueByTagReference(lv, self.data)
+                    else:
+                        sub.text = getValueByTagReference(v, self.data)
         except Exception as e:
             error(f"XML generation failed: {e} ", 1)
 
@@ -5,10 +5,55 @@
 import re
 import copy
 
+from datetime import datetime
+from io import BytesIO
+from operator import itemgetter
 from lxml import etree
-from dateutil.parser import parse as dateparse
 
-from common import makeHuman, relativePath
+from common import error, makeHuman, relativePath, hrefPath
+
+# XML parser options: allow large listings, skip whitespace-only text and ID collection,
+# never resolve entities or access the network
+_XML_OPTIONS = {"huge_tree": True, "remove_blank_text": True, "collect_ids": False, "resolve_entities": False, "no_network": True}
+
+# printf variables: {<varname>} or {<varname>:<length, l or r>}
+_PRINTF_VARIABLE = re.compile(r'{([^}:]+):?([^}]+)?}')
+
+# marks a variable without value, to be tried with its next path
+_UNSET = object()
+
+
+def _formatDate(value):
+    """ Format a date, parsing the fixed WebDAV (RFC 1123) format directly if possible """
+
+    try:
+        date = datetime.strptime(value, "%a, %d %b %Y %H:%M:%S GMT")
+    except ValueError:
+        # imported on first use, only needed for other date formats
+        from dateutil.parser import parse as dateparse
+        date = dateparse(value)
+
+    return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _variableHandler(varv):
+    """ Get a function converting a found element (or None) to the value of a variable """
+
+    vtype = varv.get("type")
+    values = varv.get("values", {})
+
+    # note: booleans are stored invertedly due to sorting algorithm
+    if vtype == "bool":
+        return lambda v: "0" if v is not None else "1"
+    elif vtype == "enum":
+        present = values["present"] if "present" in values else _UNSET
+        absent = values["absent"] if "absent" in values else _UNSET
+        return lambda v: (v.text if present is _UNSET else present) if v is not None else absent
+    elif vtype == "int":
+        return lambda v: int(v.text) if v is not None and v.text is not None else _UNSET
+
+    # treat as string
+    return lambda v: v.text if v is not None and v.text is not None else _UNSET
 
 
 class ParserFactory():
@@ -17,7 +62,7 @@ class ParserFactory():
         if p.get('scope', '') == 'headers':
             parser = HeadersParser(p, options)
         elif p.get('scope', '') == 'response':
-            if type(data) is etree._Element:
+            if type(data) is bytes or hasattr(data, 'read'):
                 if options["operation"] == 'list':
                     parser = ListXMLResponseParser(p, options)
                 else:
@@ -61,7 +106,7 @@ class Parser(dict):
         pass
 
     def format(self):
-        return copy.deepcopy(self.result)
+        return copy.copy(self.result)
 
 
 class HeadersParser(Parser):
@@ -78,110 +123,121 @@ class XMLResponseParser(ResponseParser):
 
     def _parse(self, data):
         super()._parse(data)
-        # get XML namespace map, excluding default namespace
-        nsmap = {k: v for k, v in data.nsmap.items() if k}
-        # get main namespace from root element
-        ns = data.prefix
-
-        # process result elements
-        for child in data.findall(f".//{ns}:{self['items']}", nsmap):
-            variables = {}
-
-            for var, varv in self["variables"].items():
-                for paths in varv["xpath"].split('|'):
-                    if var in variables:
-                        break
-
-                    p = f".//{ns}:" + f"/{ns}:".join(paths.split('/'))
-                    v = child.find(p, nsmap)
-
-                    # note: booleans are stored invertedly due to sorting algorithm
-                    if v is not None:
-                        if "type" in varv and varv["type"] == "bool":
-                            variables[var] = "0"
-                        elif "type" in varv and varv["type"] == "enum":
-                            if "values" in varv and "present" in varv["values"]:
-                                variables[var] = varv["values"]["present"]
-                            else:
-                                variables[var] = v.text
-                        elif v.text is not None:
-                            if "type" in varv and varv["type"] == "int":
-                                variables[var] = int(v.text)
-                            # treat as string
-                            else:
-                                variables[var] = v.text
-                    elif "type" in varv and varv["type"] == "bool":
-                        variables[var] = "1"
-                    elif "type" in varv and varv["type"] == "enum":
-                        if "values" in varv and "absent" in varv["values"]:
-                            variables[var] = varv["values"]["absent"]
-                        else:
-                            variables[var] = v.text
-
-            # add to results
-            self.result.append(variables)
+
+        # compiled paths and value handler per variable, determined once per response
+        self._plan = [(var, varv["_compiled"], _variableHandler(varv)) for var, varv in self["variables"].items()]
+
+        try:
+            append = self.result.append
+            parseItem = self._parseItem
+
+            # recognise the requested path itself by its href if it is to be hidden
+            root = self.options["source"].rstrip('/') if self.options['hide-root'] else None
+            endpoint = self.options["credentials"]["endpoint"]
+
+            # process result elements one by one while parsing
+            for event, child in etree.iterparse(data if hasattr(data, 'read') else BytesIO(data), events=('end',), tag=self["_tag"], **_XML_OPTIONS):
+                item = parseItem(child)
+                if root is not None and hrefPath(item.get('path', ''), endpoint) == root:
+                    root = None
+                else:
+                    append(item)
+
+                # free the processed element and any preceding siblings
+                child.clear()
+                while child.getprevious() is not None:
+                    del child.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            error(f"could not decode XML data: {e}")
+
+    def _parseItem(self, child):
+        variables = {}
+
+        for var, xpaths, handler in self._plan:
+            for xpath in xpaths:
+                found = xpath(child)
+                value = handler(found[0] if found else None)
+                if value is not _UNSET:
+                    variables[var] = value
+                    break
+
+        return variables
 
     def _post(self, data):
         # apply sorting etc
         if self.options['sort'] and self.options['dirs-first']:
-            self.result.sort(key=lambda x: x['type'] + x['path'].lower(), reverse=self.options['reverse'])
+            self.result.sort(key=lambda x: (x['type'], x['path'].lower()), reverse=self.options['reverse'])
         elif self.options['sort']:
             self.result.sort(key=lambda x: x['path'].lower(), reverse=self.options['reverse'])
         elif self.options['dirs-first']:
-            self.result.sort(key=lambda x: x['type'], reverse=self.options['reverse'])
-
-        if self.options['hide-root'] and len(self.result):
-            self.result = self.result[1:]
+            self.result.sort(key=itemgetter('type'), reverse=self.options['reverse'])
 
 
 class ListXMLResponseParser(XMLResponseParser):
     def _post(self, data):
         super()._post(data)
 
-        # filtering
-        if self.options['list-empty']:
-            self.result = list(filter(lambda x: x['type'] == 'd' and x['size'] == 0, self.result))
-        # filter dirs (wins) or files
-        if self.options['dirs-only']:
-            self.result = list(filter(lambda x: x['type'] == 'd', self.result))
-        elif self.options['files-only']:
-            self.result = list(filter(lambda x: x['type'] == 'f', self.result))
+        # filter empty directories, and dirs (wins) or files
+        empty = self.options['list-empty']
+        dirs = self.options['dirs-only']
+        files = self.options['files-only'] and not dirs
+
+        # filtering in a single pass
+        if empty or dirs or files:
+            self.result = [x for x in self.result
+                           if (not empty or (x['type'] == 'd' and x['size'] == 0))
+                           and (not dirs or x['type'] == 'd')
+                           and (not files or x['type'] == 'f')]
 
     def format(self):
-        printResult = ""
+        printResult = []
         printf = self.options.get("printf", "")
 
         # find {<varname>:<length>}
-        matching = re.findall(r'{([^}:]+):?([^}]+)?}', printf)
+        matching = _PRINTF_VARIABLE.findall(printf)
 
         if not matching:
             return printf
 
+        # converted values by original value, listings repeat dates and sizes a lot
+        dates = {}
+        sizes = {}
+
+        # constant lookups used for every element
+        recursive = self.options['recursive']
+        root = self.options["root"]
+        endpoint = self.options["credentials"]["endpoint"]
+        names = [var[0] for var in matching]
+
         # loop through result list
         results = []
         for item in self.result:
-            if self.options['recursive'] and item['type'] == 'd':
+            if recursive and item['type'] == 'd':
                 continue
 
-            # determine and possibly update all found variables
-            result = copy.deepcopy(item)
-            for var in matching:
+            # determine all found variables, only these are needed for printing
+            result = {}
+            for name in names:
                 # if found variable exists
-                if var[0] in result:
+                if name in item:
                     # get the original value
-                    val = result[var[0]]
+                    val = item[name]
                     # special treatment per variable
-                    if var[0] == "path":
-                        val = relativePath(result, var[0], self.options["root"], self.options["credentials"]["endpoint"])
-                    elif var[0] == "date":
-                        val = dateparse(val).strftime("%Y-%m-%d %H:%M:%S")
-                    elif var[0] == "size":
-                        val = makeHuman(val)
+                    if name == "path":
+                        val = relativePath(item, name, root, endpoint)
+                    elif name == "date":
+                        if val not in dates:
+                            dates[val] = _formatDate(val)
+                        val = dates[val]
+                    elif name == "size":
+                        if val not in sizes:
+                            sizes[val] = makeHuman(val)
+                        val = sizes[val]
                 else:
                     val = None
 
                 # update temporary result array with sanity check
-                result[var[0]] = val if val else ""
+                result[name] = val if val else ""
 
             results.append(result)
 
@@ -194,39 +250,44 @@ class ListXMLResponseParser(XMLResponseParser):
                 lengths = list(map(lambda x: len(x[var[0]]), results))
                 maxs[var[0]] = str(max(lengths)) if len(lengths) > 0 else '0'
 
-        # list all elements
-        for result in results:
-            text = printf
-
-            # determine all variables
-            for var in matching:
-                val = result[var[0]]
-
-                # justification
-                if var[1] > '':
-                    if var[1].isdigit():
-                        val = ("%" + var[1] + "s") % val
-                    elif var[1] == 'l':
-                        val = ("%-" + maxs[var[0]] + "s") % val
-                    elif var[1] == 'r':
-                        val = ("%" + maxs[var[0]] + "s") % val
-
-                # replace variable with value
-                text = text.replace("{%s}" % ":".join(filter(lambda x: x > '', list(var))), val)
+        # build a single positional template for a line once, with the justification of each variable
+        template = []
+        last = 0
+        for i, m in enumerate(_PRINTF_VARIABLE.finditer(printf)):
+            template.append(printf[last:m.start()].replace('{', '{{').replace('}', '}}'))
+            spec = m.group(2) or ''
+            if spec.isdigit():
+                template.append("{%d:>%s}" % (i, spec))
+            elif spec == 'l':
+                template.append("{%d:<%s}" % (i, maxs[m.group(1)]))
+            elif spec == 'r':
+                template.append("{%d:>%s}" % (i, maxs[m.group(1)]))
+            else:
+                template.append("{%d}" % i)
+            last = m.end()
+        template.append(printf[last:].replace('{', '{{').replace('}', '}}') + "\n")
+        template = "".join(template)
 
-            # print resulting string
-            printResult += "%s\n" % text
+        # list all elements, formatting each in a single call
+        for result in results:
+            printResult.append(template.format(*[result[name] for name in names]))
 
-        return printResult
+        # join all lines at once
+        return "".join(printResult)
 
     def format_summary(self):
-        # filter out any directory if recursive
-        res = copy.deepcopy(self.result) if not self.options['recursive'] else list(filter(lambda x: x['type'] != "d", self.result))
-
-        # get total size, directory and file counts
-        lsum = sum(map(lambda x: x['size'], res))
-        dcount = len(list(filter(lambda x: x['type'] == 'd', res)))
-        fcount = len(res) - dcount
+        recursive = self.options['recursive']
+
+        # get total size, directory and file counts in a single pass, skipping directories if recursive
+        lsum = dcount = fcount = 0
+        for x in self.result:
+            if x['type'] == 'd':
+                if recursive:
+                    continue
+                dcount += 1
+            else:
+                fcount += 1
+            lsum += x['size']
 
         # print total size, file count if > 0, directory count if > 0
         return "%s %s%s%s%s%s\n" % ("\n" if len(self.result) > 0 else "",
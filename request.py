@@ -1,26 +1,59 @@
-import cchardet
 import re
 import requests
-import simplejson
 
-from lxml import etree
-from common import error, verbose, debug, warning
+from common import error, verbose, debug, warning, loadJSON
+
+# successful response status codes
+_SUCCESS = frozenset((200, 201, 204, 207))
+
+# self-describing content types, parsed from bytes
+_XML_TYPES = ('application/xml', 'text/xml')
+_JSON_TYPES = ('application/json', 'text/json')
+
+# download disposition header: attachment; ... filename="<name>"
+_ATTACHMENT = 'attachment;'
+_FILENAME = 'filename="'
+
+# download checksum header: <algorithm>:<hex value>
+_CHECKSUM = re.compile(r'^([^:]+):([0-9a-f]+)$')
+
+
+def _dispositionFilename(disposition):
+    """ Get the filename of an attachment disposition, or None if invalid """
+
+    # use the last quoted non-empty filename, falling back to earlier ones
+    end = len(disposition)
+    while True:
+        start = disposition.rfind(_FILENAME, 0, end)
+        if start < 0:
+            return None
+        name, quote, _ = disposition[start + len(_FILENAME):].partition('"')
+        if name and quote:
+            break
+        end = start
+
+    # something must separate the attachment type and the filename
+    head = disposition[:start]
+    return name if head.startswith(_ATTACHMENT) and head != _ATTACHMENT else None
+
 
 class DAVRequest():
     """ WebDAV request class for WebDAV-enabled servers """
 
-    SUCCESS = [200, 201, 204, 207]
+    SUCCESS = _SUCCESS
 
-    def __init__(self, options={}):
+    def __init__(self, options={}, session=None):
         self.options = options
+        self.session = session if session is not None else requests.Session()
         self.result = None
         self.request = None
         self.response = None
         self.download = {}
         self.success = False
 
-    def run(self, method, path, headers={}, params={}, data="", expectedStatus=SUCCESS, auth=None, quiet=False):
-        verbose("Request data: %s" % (data[:1000] if type(data) is str else type(data)))
+    def run(self, method, path, headers={}, params={}, data="", expectedStatus=_SUCCESS, auth=None, quiet=False, stream=False, raw=False):
+        # truncated while formatting, so nothing is sliced unless printed
+        verbose("Request data: %.1000s", data if type(data) is str else type(data))
 
         if self.options['head']:
             method = "HEAD"
@@ -33,99 +66,111 @@ class DAVRequest():
         # construct request
         req = requests.Request(method, url, headers=headers, params=params, data=data, auth=auth)
 
-        self.request = req.prepare()
+        self.request = self.session.prepare_request(req)
         self.success = False
 
-        verbose("Request headers: %s" % self.request.headers)
+        verbose("Request headers: %s", self.request.headers)
 
         # exit if dry-run
         if self.options['dry-run']:
-            warning("dry-run: " + method.upper() + " " + req.url)
+            warning("dry-run: %s %s", method.upper(), req.url)
             return False
 
         # some debug messages
-        verbose("Options: %s" % self.options)
-        debug(method.upper() + " " + self.request.url)
+        verbose("Options: %s", self.options)
+        debug("%s %s", method.upper(), self.request.url)
 
-        # do request
+        # do request, reusing the connections of the session, the body is read on demand,
+        # redirects are not followed but reported as failure, WebDAV endpoints do not move
         try:
-            s = requests.Session()
-            self.response = s.send(self.request, verify=not self.options['no-verify'], timeout=30)
+            self.response = self.session.send(self.request, verify=not self.options['no-verify'], timeout=30, stream=True,
+                                              allow_redirects=False)
         except requests.exceptions.ReadTimeout:
             error("request time out after 30 seconds", 2)
         except requests.exceptions.SSLError as e:
             error(e, 2)
 
-        # determine the encoding of the response text
-        if self.response.encoding is None:
-            self.response.encoding = cchardet.detect(self.response.content)['encoding']
-
         # print headers, exit if only head request
         if self.options['headers'] or self.options['head']:
-            debug(f"Response headers: {self.response.headers}", True)
+            debug("Response headers: %s", self.response.headers, force=True)
             if self.options['head']:
                 return False
 
-        debug(f"Response: {self.response.status_code} {self.response.reason}")
-        verbose(f"Response: {self.response.text}")
-
-        # init result
-        self.result = self.response.text
-
-        # if failed exit
-        if self.response.status_code not in expectedStatus:
-            return self.result  # self._requestfail() if not quiet else False
+        debug("Response: %s %s", self.response.status_code, self.response.reason)
 
         # check if downloading file
-        if 'Content-Disposition' in self.response.headers:
-            # extract filename
-            m = re.match(r'attachment;.+filename="([^"]+)"', self.response.headers['Content-Disposition'])
-            if not m:
-                error("invalid response header disposition value: %s" % self.response.headers['Content-Disposition'], 1)
+        if self.response.status_code in expectedStatus and 'Content-Disposition' in self.response.headers:
+            # extract filename: attachment; ... filename="<name>"
+            disposition = self.response.headers['Content-Disposition']
+            name = _dispositionFilename(disposition)
+            if name is None:
+                error("invalid response header disposition value: %s" % disposition, 1)
             else:
-                self.download['filename'] = m.group(1)
+                self.download['filename'] = name
             # extract checksum if available
             if 'OC-Checksum' in self.response.headers:
-                m = re.match(r'^([^:]+):([0-9a-f]+)$', self.response.headers['OC-Checksum'])
+                m = _CHECKSUM.match(self.response.headers['OC-Checksum'])
                 if m:
                     self.download['checksum'] = {
                         'algorithm': m.group(1),
                         'value': m.group(2)
                     }
 
-        # parse based on given content type
-        if 'Content-Type' in self.response.headers and not self.options['no-parse']:
-            info = self.response.headers['Content-Type'].split(';')
-            if info[0] in ['application/xml', 'text/xml']:
-                try:
-                    self.result = etree.fromstring(self.result.encode('ascii'))
-                except Exception as e:
-                    error(f"could not decode XML data: {e}")
-            elif info[0] in ['application/json', 'text/json']:
-                try:
-                    self.result = simplejson.loads(self.result)
-                except Exception as e:
-                    error(f"could not decode JSON data: {e}")
+        # leave the body of a streamed response unread, to be written by the caller
+        if stream and self.response.status_code in expectedStatus:
+            self.result = self.response
+            self.success = True
+            return self.result
+
+        # pass raw XML data on to callers that parse it, the response parsers parse it incrementally
+        # and read the encoding from the XML declaration, so skip decoding the text
+        ctype = self.response.headers.get('Content-Type', '')
+        if raw and self.response.status_code in expectedStatus and not self.options['no-parse'] and ctype.startswith(_XML_TYPES):
+            if self.options['verbose']:
+                verbose("Response: %s", self._text())
+                self.result = self.response.content
+            else:
+                # parse while receiving, decompressing the body if required
+                self.response.raw.decode_content = True
+                self.result = self.response.raw
+            self.success = True
+            return self.result
+
+        # decode JSON data directly from the raw bytes, skipping the text decoding, unless
+        # another charset than UTF-8 is declared
+        if self.response.status_code in expectedStatus and not self.options['no-parse'] and ctype.startswith(_JSON_TYPES):
+            utf8 = self.response.encoding is None or self.response.encoding.lower() in ['utf-8', 'utf8']
+            if self.options['verbose']:
+                verbose("Response: %s", self._text())
+            try:
+                self.result = loadJSON(self.response.content if utf8 else self.response.text)
+            except Exception as e:
+                error(f"could not decode JSON data: {e}")
+                self.result = self.response.text
+            self.success = True
+            return self.result
+
+        # trust the declared charset of the response text, default to UTF-8
+        if self.response.encoding is None:
+            self.response.encoding = 'utf-8'
+
+        # init result, decoding the text only once
+        self.result = self.response.text
+
+        verbose("Response: %s", self.result)
+
+        # if failed exit
+        if self.response.status_code not in expectedStatus:
+            return self.result
 
         self.success = True
 
         return self.result
 
     def hassuccess(self):
-        return self.response is not None and self.response.status_code in DAVRequest.SUCCESS
-
-    def _requestfail(self):
-        message = ""
-        if self.response.status_code >= 400 and self.response.status_code < 500:
-            if isinstance(self.result, etree._Element):
-                nsmap = {k: v for k, v in self.result.nsmap.items() if k}
-                message = self.result.find('.//s:message', nsmap).text
-
-        return error('%s (%s)%s' % (self.response.reason, self.response.status_code, ": %s" % message if message > "" else ""))
+        return self.response is not None and self.response.status_code in _SUCCESS
 
+    def _text(self):
+        # response body decoded for display only, the parsers get the bytes
+        return self.response.content.decode(self.response.encoding or 'utf-8', 'replace')
 
-class DAVAuthRequest(DAVRequest):
-    def run(self, method, path, headers={}, params={}, data="", expectedStatus=DAVRequest.SUCCESS, quiet=False):
-        return DAVRequest.run(self, method, path, headers, params, data, expectedStatus,
-                              auth=(self.options["credentials"]["user"], self.options["credentials"]["token"]) if 'Authorization' not in headers else None,
-                              quiet=quiet)